@@ -0,0 +1,731 @@
+"@author: Andrew Martin, 2024"
+
+import os
+import sys
+import subprocess
+import shutil
+import csv
+from datetime import datetime
+import ctypes
+import json
+import atexit
+import queue
+import threading
+import zipfile
+import multiprocessing
+from functools import lru_cache
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try: # Optional, if it's installed copies on Linux go through io_uring
+    import pyuring
+except ImportError:
+    pyuring = None
+
+try: # Optional, if it's installed WAVs get encoded in process instead of starting ffmpeg for each one
+    import av
+except ImportError:
+    av = None
+
+try: # Optional, parses config.json faster than the json module if it's installed
+    import orjson
+except ImportError:
+    orjson = None
+
+# Sets the limit as 18 TB then converts that to bits
+MAX_STORAGE_LIMIT_TB = 18
+MAX_STORAGE_LIMIT_BYTES = MAX_STORAGE_LIMIT_TB * 1024**4
+
+# ffmpeg's options for every command, -nostdin so it never waits on the console, -nostats so it doesn't write progress
+# lines and only errors get printed
+FFMPEG_CMD = ['ffmpeg', '-nostdin', '-nostats', '-loglevel', 'error']
+
+# CopyFileExW flag that makes it fail instead of overwriting
+COPY_FILE_FAIL_IF_EXISTS = 0x00000001
+
+# How many regular file copies run at once, each one mostly waits on the drives so they overlap well
+COPY_WORKERS = 8
+
+# What "priority" in config.json can be set to, the Windows priority class and the nice value used everywhere else
+PRIORITIES = {
+    'below_normal': (0x00004000, 10),
+    'normal': (0x00000020, 0),
+    'high': (0x00000080, -10)
+}
+
+# With "stream_input" in config.json WAVs get read in one go and piped to ffmpeg. This is how much memory all the jobs
+# together can hold that way, each job streams WAVs up to its share of it and ffmpeg reads bigger ones itself
+STREAM_INPUT_BUDGET_BYTES = 512 * 1024**2
+
+# With "aggregate_small_files" in config.json, regular files under "aggregate_threshold" bytes get stored in one of
+# these per destination folder instead of being copied one by one
+SIDECARS_FILE = 'sidecars.zip'
+AGGREGATE_THRESHOLD = 64 * 1024
+
+# How much of each queued WAV the walker asks Linux to read ahead, enough to get the encoder going without pulling
+# whole multi GB files into the page cache
+PREFETCH_BYTES = 8 * 1024**2
+
+# What "encoder" in config.json can be set to, flake and flac are called directly instead of going through ffmpeg
+ENCODERS = ('ffmpeg', 'flake', 'flac')
+
+# WAVs smaller than this get converted SMALL_WAV_BATCH at a time by one ffmpeg
+SMALL_WAV_BYTES = 1024**2
+SMALL_WAV_BATCH = 16
+
+# The destination's free space gets checked again after this much has been copied
+SPACE_RECHECK_BYTES = 1024**3
+
+# Every file that gets converted or copied is recorded in here with its modified time and size, saved every
+# MANIFEST_SAVE_INTERVAL files, so compare_and_copy can skip unchanged files without looking at the destination
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_SAVE_INTERVAL = 1000
+
+# A WAV to convert or file to copy, the paths are source relative, source and destination
+Job = namedtuple('Job', ['kind', 'relative_path', 'input_file_path', 'output_file_path', 'file_size', 'mtime_ns'])
+
+# Failures get written to the csv by a single thread so nothing fights over the file, flushed every FAILURE_FLUSH_ROWS rows
+_failure_queue = queue.Queue()
+FAILURE_FLUSH_ROWS = 100
+
+def load_config(filename): # Get source/destination and csv file from config.json, empty if there isn't one
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def log_failure(file_name, timestamp, user, drive_name, directory): # Queues a copy failure for the csv writer thread
+    _failure_queue.put([file_name, timestamp, user, drive_name, directory])
+
+def write_failures(csv_file): # Runs on its own thread, keeps the csv file open and writes the failures as they come in
+    file = None
+    rows_since_flush = 0
+    try:
+        while True:
+            row = _failure_queue.get()
+            if row is None:
+                break
+            if file is None: # Only creates the csv once something has actually failed
+                file = open(csv_file, mode='a', newline='', encoding='utf-8', buffering=1024**2)
+                writer = csv.writer(file)
+            writer.writerow(row)
+
+            rows_since_flush += 1
+            if rows_since_flush >= FAILURE_FLUSH_ROWS or _failure_queue.empty(): # Flushes in bursts, but never leaves rows
+                file.flush()                                                     # sitting in the buffer once it's quiet
+                rows_since_flush = 0
+    finally:
+        if file is not None:
+            file.close()
+
+def start_failure_log(csv_file): # Starts the csv writer thread, it also gets stopped at exit in case the run never gets to
+    csv_file = os.path.join(os.path.dirname(__file__), csv_file) # stop_failure_log
+    thread = threading.Thread(target=write_failures, args=(csv_file,), daemon=True)
+    thread.start()
+    atexit.register(stop_failure_log, thread)
+    return thread
+
+def stop_failure_log(thread): # Tells the csv writer thread to finish up and waits for it
+    if thread.is_alive():
+        _failure_queue.put(None)
+        thread.join()
+
+@lru_cache(maxsize=32)
+def get_drive_name(drive): # Gets the name of source directory, cached since the drive doesn't change during a run
+    try:
+        if os.name == 'nt':
+            drive = os.path.splitdrive(drive)[0] + '\\'
+            volume_name = ctypes.create_unicode_buffer(1024)
+            ctypes.windll.kernel32.GetVolumeInformationW(
+                ctypes.c_wchar_p(drive),
+                volume_name,
+                ctypes.sizeof(volume_name),
+                None,
+                None,
+                None,
+                None,
+                0
+            )
+            return volume_name.value
+    except Exception as e:
+        print(f"Error retrieving drive name for {drive}: {e}")
+    return drive
+
+def convert_with_pyav(input_file_path, output_file_path, threads=1, channels=None): # Encodes the FLAC with PyAV in this process,
+    with av.open(input_file_path) as input_container:                                # same settings as the ffmpeg command
+        input_stream = input_container.streams.audio[0]
+        with av.open(output_file_path, 'w', format='flac') as output_container:
+            output_stream = output_container.add_stream('flac', rate=input_stream.rate, options={'compression_level': '5'})
+            output_stream.codec_context.thread_count = threads
+            if channels: # Same names ffmpeg's -ac picks for mono and stereo, anything else is just a channel count
+                output_stream.codec_context.layout = {1: 'mono', 2: 'stereo'}.get(channels, f'{channels}c')
+            else:
+                output_stream.codec_context.layout = input_stream.layout
+            output_stream.codec_context.format = 's16' if input_stream.format.bits <= 16 else 's32' # Keeps 24 bit WAVs at 24 bit
+
+            for frame in input_container.decode(input_stream):
+                for packet in output_stream.encode(frame):
+                    output_container.mux(packet)
+            for packet in output_stream.encode(None): # Flushes whatever the encoder is still holding
+                output_container.mux(packet)
+
+def flac_output_args(threads=1, channels=None): # The encoder settings for every FLAC ffmpeg writes
+    args = ['-threads', str(threads), '-c:a', 'flac', '-compression_level', '5']
+    if channels:
+        args += ['-ac', str(channels)]
+    return args
+
+def convert_wav_to_flac(input_file_path, output_file_path, threads=1, channels=None,
+                        stream_input=0): # Convert WAV files to FLAC, keeps the source channels unless told otherwise,
+    if av is not None:                       # stream_input is the biggest WAV to pipe in (0 never does)
+        try:
+            convert_with_pyav(input_file_path, output_file_path, threads, channels)
+            print(f'Converted {input_file_path} to FLAC')
+            return True
+        # Anything PyAV can't handle (no audio stream, a layout or format it won't take) gets another go with ffmpeg
+        except (av.error.FFmpegError, IndexError, ValueError) as e:
+            print(f'PyAV could not convert {input_file_path}, trying ffmpeg: {e}')
+            if os.path.exists(output_file_path):
+                os.remove(output_file_path)
+
+    try:
+        input_data = None
+        if stream_input and os.path.getsize(input_file_path) <= stream_input: # Reads the whole WAV in one go and
+            with open(input_file_path, 'rb') as f:                             # pipes it in, so a slow source
+                input_data = f.read()                                          # drive gets one big sequential read
+            ffmpeg_cmd = FFMPEG_CMD + ['-threads', str(threads), '-f', 'wav', '-i', 'pipe:0']
+        else:
+            ffmpeg_cmd = FFMPEG_CMD + ['-threads', str(threads), '-i', input_file_path]
+        ffmpeg_cmd += flac_output_args(threads, channels) + [output_file_path]
+
+        subprocess.run(ffmpeg_cmd, input=input_data, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       creationflags=encoder_priority())
+        print(f'Converted {input_file_path} to FLAC')
+        return True
+    except subprocess.CalledProcessError as e:
+        error = e.stderr.decode('utf-8', errors='replace') # Only decoded once it's actually failed
+        print(f'Failed to convert {input_file_path} to FLAC: {error}')
+    except OSError as e: # ffmpeg isn't installed, or the WAV couldn't be read to stream it
+        print(f'Failed to convert {input_file_path} to FLAC: {e}')
+    return False
+
+def convert_wav_batch(files, threads=1, channels=None): # Converts a batch of short WAVs with one ffmpeg, since for files
+    ffmpeg_cmd = list(FFMPEG_CMD)                        # that short starting ffmpeg takes longer than the encoding
+    for input_file_path, _ in files:
+        ffmpeg_cmd += ['-threads', str(threads), '-i', input_file_path]
+    for index, (_, output_file_path) in enumerate(files):
+        ffmpeg_cmd += ['-map', f'{index}:a:0'] + flac_output_args(threads, channels) + [output_file_path]
+
+    try:
+        subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       creationflags=encoder_priority())
+    except subprocess.CalledProcessError: # One bad file fails the lot, so clear out what got written and do them one
+        for _, output_file_path in files: # at a time to find which it was
+            if os.path.exists(output_file_path):
+                os.remove(output_file_path)
+        return [convert_wav_to_flac(input_file_path, output_file_path, threads, channels)
+                for input_file_path, output_file_path in files]
+    except OSError as e: # Usually ffmpeg isn't installed or isn't on the PATH, so none of them can be done
+        for input_file_path, output_file_path in files:
+            print(f'Failed to convert {input_file_path} to FLAC: {e}')
+            if os.path.exists(output_file_path):
+                os.remove(output_file_path)
+        return [False] * len(files)
+
+    for input_file_path, _ in files:
+        print(f'Converted {input_file_path} to FLAC')
+    return [True] * len(files)
+
+def encoder_cmd(encoder, input_file_path, output_file_path, block_size=None, lpc_order=None): # The command line for flake or
+    if encoder == 'flake':                                                                      # the reference flac encoder
+        cmd = ['flake', '-5']
+    else:
+        cmd = ['flac', '--best', '--silent', '--force']
+    if block_size:
+        cmd += ['-b', str(block_size)]
+    if lpc_order:
+        cmd += ['-l', str(lpc_order)]
+    if encoder == 'flake':
+        return cmd + [input_file_path, '-o', output_file_path]
+    return cmd + ['-o', output_file_path, input_file_path]
+
+def convert_with_encoder(input_file_path, output_file_path, encoder, block_size=None, lpc_order=None): # Converts with flake or
+    try:                                                                                                # flac instead of ffmpeg,
+        cmd = encoder_cmd(encoder, input_file_path, output_file_path, block_size, lpc_order)           # they read the WAV
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,             # directly
+                       creationflags=encoder_priority())
+        print(f'Converted {input_file_path} to FLAC')
+        return True
+    except subprocess.CalledProcessError as e:
+        error = e.stderr.decode('utf-8', errors='replace')
+        print(f'Failed to convert {input_file_path} to FLAC: {error}')
+    except OSError as e: # Usually the encoder isn't installed or isn't on the PATH
+        print(f'Failed to convert {input_file_path} to FLAC: {e}')
+    if os.path.exists(output_file_path):
+        os.remove(output_file_path)
+    return False
+
+def copy_file(input_file_path, output_file_path): # Copy from source to destination, never over a file that's already there
+    try:
+        if os.name == 'nt': # Lets Windows copy it in the kernel, same call Explorer uses
+            copied = ctypes.windll.kernel32.CopyFileExW(
+                ctypes.c_wchar_p(input_file_path),
+                ctypes.c_wchar_p(output_file_path),
+                None,
+                None,
+                None,
+                COPY_FILE_FAIL_IF_EXISTS # Checks and creates in one go, ERROR_FILE_EXISTS comes back as FileExistsError
+            )
+            if not copied:
+                raise ctypes.WinError()
+        else:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+            os.close(os.open(output_file_path, flags, 0o666)) # Claims the name first so two runs can't both copy to it,
+            try:                                              # same permissions a normal open would give it
+                if pyuring is not None and sys.platform == 'linux':
+                    pyuring.copy(input_file_path, output_file_path)
+                else:
+                    shutil.copyfile(input_file_path, output_file_path) # Lets Python use the OS fast copy (sendfile, fcopyfile, etc.)
+            except BaseException:
+                os.remove(output_file_path) # Don't leave a half copy behind that would get skipped next time
+                raise
+        print(f'Copied {input_file_path} to {output_file_path}')
+        return True
+    except FileExistsError:
+        print(f'Skipping copy of {input_file_path}, file already exists in destination.')
+        return True
+    except IOError as e:
+        print(f'Failed to copy {input_file_path} to {output_file_path}: {e}')
+        log_file_failure(input_file_path)
+    return False
+
+def add_to_sidecars(job, sidecars): # Stores a small file in its folder's sidecars.zip. The files of a folder come one after
+    folder, name = os.path.split(job.output_file_path) # the other so only that folder's zip is open in sidecars, and it's
+    path = os.path.join(folder, SIDECARS_FILE)          # written as a copy that only replaces the real one once it's closed,
+    try:                                                # so killing the run can't break the files already in it
+        if not sidecars:
+            if os.path.exists(path + '.tmp'): # Left over from a run that got killed, so it's missing its index
+                os.remove(path + '.tmp')
+            if os.path.exists(path):
+                shutil.copyfile(path, path + '.tmp')
+            archive = zipfile.ZipFile(path + '.tmp', 'a', compression=zipfile.ZIP_STORED)
+            sidecars.update(folder=folder, archive=archive, names=set(archive.namelist()), stored=[])
+        if name in sidecars['names']:
+            print(f'Skipping copy of {job.input_file_path}, file already exists in {SIDECARS_FILE}.')
+        else:
+            sidecars['archive'].write(job.input_file_path, arcname=name)
+            sidecars['names'].add(name)
+            print(f'Stored {job.input_file_path} in {path}')
+        sidecars['stored'].append(job)
+        return True
+    except (OSError, zipfile.BadZipFile) as e:
+        print(f'Failed to store {job.input_file_path} in {SIDECARS_FILE}: {e}')
+        log_file_failure(job.input_file_path)
+    return False
+
+def close_sidecars(sidecars): # Finishes the open zip and swaps it in for the real one, returns the jobs stored in it since
+    stored = sidecars.get('stored', [])                       # they only count as done from here
+    if sidecars:
+        path = os.path.join(sidecars['folder'], SIDECARS_FILE)
+        try:
+            sidecars['archive'].close()
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f'Failed to write {path}: {e}')
+            for job in stored:
+                log_file_failure(job.input_file_path)
+            stored = []
+    sidecars.clear()
+    return stored
+
+def get_available_space(path): # Sees how much space is available on the drive holding path
+    return shutil.disk_usage(path).free
+
+def default_jobs(): # Half the cores by default so the ffmpeg processes don't fight each other for CPU
+    return max(1, (os.cpu_count() or 2) // 2)
+
+def default_ffmpeg_threads(jobs): # Splits the cores between the parallel jobs so the ffmpegs don't oversubscribe the CPU
+    return max(1, (os.cpu_count() or 1) // jobs)
+
+@lru_cache(maxsize=None)
+def get_user(): # Looks up who's running the copy once, it can't change mid run
+    return os.getlogin()
+
+def set_priority(priority): # Runs the script at a lower priority for background runs or higher for a dedicated machine,
+    priority_class, niceness = PRIORITIES[priority] # the encoders pick it up through encoder_priority
+    try:
+        if os.name == 'nt':
+            kernel32 = ctypes.windll.kernel32
+            if not kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), priority_class):
+                raise ctypes.WinError()
+        else:
+            os.nice(niceness - os.nice(0))
+    except OSError as e: # Raising it usually needs admin, so it just carries on at the normal priority
+        print(f'Could not set priority to {priority}: {e}')
+
+def encoder_priority(): # Flags that start an encoder at the same priority as this process. Windows only passes on idle
+    if os.name != 'nt':  # and below normal by itself, elsewhere the nice value is always inherited
+        return 0
+    kernel32 = ctypes.windll.kernel32
+    return kernel32.GetPriorityClass(kernel32.GetCurrentProcess())
+
+def log_file_failure(input_file_path): # Gathers the details for a failed file and logs them, only worked out once something fails
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    user = get_user()
+    drive, directory = os.path.splitdrive(input_file_path)
+    log_failure(os.path.basename(input_file_path), timestamp, user, get_drive_name(drive), directory)
+
+def _convert_batch(batch, encoder='ffmpeg', block_size=None, lpc_order=None, stream_input=0, **convert_options): # Runs
+    files = [(job.input_file_path, job.output_file_path) for job in batch]                           # inside a worker,
+    if encoder != 'ffmpeg':                                                                          # returns whether
+        return [convert_with_encoder(*file, encoder, block_size, lpc_order) for file in files]       # each job in the
+    if len(files) == 1:                                                                              # batch converted
+        return [convert_wav_to_flac(*files[0], stream_input=stream_input, **convert_options)]
+    return convert_wav_batch(files, **convert_options)
+
+def with_sep(path): # Adds the trailing separator once so paths under it can just be added on
+    return path if path.endswith(('/', os.sep)) else path + os.sep
+
+def scan_tree(path, relative_path=''): # Walks a folder with os.scandir so the file info comes straight from the directory
+    try:                                 # listing, skipping hidden folders and System Volume Information. Each entry
+        with os.scandir(path) as it:     # comes with its path relative to where the walk started, built up as it goes
+            entries = list(it)           # instead of worked out for every file
+    except OSError as e:
+        print(f'Failed to read directory {path}: {e}')
+        return
+
+    folders = []
+    for entry in entries:
+        if entry.is_dir():
+            folders.append(entry)
+        else: # All of a folder's files come before its subfolders, so the sidecars.zip for it only gets opened once
+            yield entry, relative_path + entry.name
+
+    for entry in folders:
+        if entry.name.startswith('.') or entry.name.lower() == 'system volume information':
+            continue
+        yield entry, relative_path + entry.name
+        if not entry.is_symlink(): # Same as os.walk, linked folders get made but not followed
+            yield from scan_tree(entry.path, relative_path + entry.name + os.sep)
+
+def in_folder_listing(output_file_path, folder_listings): # Checks a destination path against a listing of its folder that
+    folder, name = os.path.split(output_file_path)            # gets read once, so each folder costs one scandir instead of a
+    names = folder_listings.get(folder)
+    if names is None:
+        try:
+            with os.scandir(folder) as it:
+                names = {os.path.normcase(entry.name) for entry in it}
+        except OSError: # Not made yet, or something's in the way of it, either way nothing's there
+            names = set()
+        folder_listings[folder] = names                       # stat per file
+    return os.path.normcase(name) in names
+
+def manifest_path(): # The manifest lives next to the script, same as the csv
+    return os.path.join(os.path.dirname(__file__), MANIFEST_FILE)
+
+def load_manifest(source, drive_folder): # Returns the files a previous run from this source into this destination finished,
+    try:                                  # keyed by their path in the source
+        with open(manifest_path(), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get('source') != os.path.abspath(source) or manifest.get('destination') != os.path.abspath(drive_folder):
+        return {}
+    try:
+        with os.scandir(drive_folder) as it:
+            if next(it, None) is None: # The destination got emptied or wiped since, so nothing in it is done anymore
+                return {}
+    except OSError:
+        return {}
+    return manifest.get('files', {})
+
+def save_manifest(source, drive_folder, files): # Writes to a temp file then swaps it in so a crash mid write can't leave a
+    path = manifest_path()                       # broken manifest
+    with open(path + '.tmp', 'w') as f:
+        json.dump({
+            'source': os.path.abspath(source),
+            'destination': os.path.abspath(drive_folder),
+            'saved': datetime.now().isoformat(timespec='seconds'),
+            'files': files
+        }, f)
+    os.replace(path + '.tmp', path)
+
+def is_unchanged(job, manifest): # The file was done last time and hasn't been modified since
+    entry = manifest.get(job.relative_path)
+    return entry is not None and entry[0] == job.mtime_ns and entry[1] == job.file_size
+
+def iter_jobs(source, drive_folder): # Walks the source and yields a Job for every WAV to convert and file to copy, making
+    total_copied_size = 0              # the destination folders as it goes
+    destination_root = with_sep(drive_folder)
+    for entry, relative_file_path in scan_tree(source):
+        input_file_path = entry.path
+
+        if entry.is_dir():
+            try:
+                os.makedirs(destination_root + relative_file_path, exist_ok=True)
+            except OSError as e: # One folder that can't be made (a file in the way etc.) shouldn't stop the whole walk
+                print(f'Failed to create directory {destination_root + relative_file_path}: {e}')
+                log_file_failure(input_file_path)
+            continue
+
+        try:
+            stat = entry.stat() # Comes from the directory listing on Windows, so it's free
+        except OSError as e:
+            print(f'Failed to read {input_file_path}: {e}')
+            log_file_failure(input_file_path)
+            continue
+
+        relative_stem, extension = os.path.splitext(relative_file_path)
+        if extension.lower() == '.wav':
+            output_file_path = destination_root + relative_stem + '.flac'
+            yield Job('wav', relative_file_path, input_file_path, output_file_path, stat.st_size, stat.st_mtime_ns)
+            continue
+
+        total_copied_size += stat.st_size
+        if total_copied_size > MAX_STORAGE_LIMIT_BYTES:
+            print(f'Exceeded maximum storage limit of {MAX_STORAGE_LIMIT_TB} TB.')
+            return
+        output_file_path = destination_root + relative_file_path
+        yield Job('copy', relative_file_path, input_file_path, output_file_path, stat.st_size, stat.st_mtime_ns)
+
+def prefetch_file(input_file_path): # Gets the drive reading a file before a worker asks for it, so the reads overlap the
+    try:                              # encodes instead of waiting on them
+        if hasattr(os, 'posix_fadvise'): # Linux reads the start of it into the page cache in the background
+            fd = os.open(input_file_path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        else: # Windows has no hint for it, reading the first byte at least warms up network shares
+            with open(input_file_path, 'rb') as f:
+                f.read(1)
+    except OSError:
+        pass # Only a hint, the worker reports it if the file really can't be read
+
+def produce_jobs(source, drive_folder, job_queue, manifest, errors): # Runs on its own thread so the walk keeps going while
+    folder_listings = {}                                              # the files ahead of it are being converted and copied,
+    try:                                                              # skipping anything the manifest or destination has
+        for job in iter_jobs(source, drive_folder):
+            if is_unchanged(job, manifest): # Doesn't touch the destination at all
+                continue
+            if in_folder_listing(job.output_file_path, folder_listings):
+                if job.kind == 'copy':
+                    print(f'Skipping copy of {job.input_file_path}, file already exists in destination.')
+                continue
+            if job.kind == 'wav': # Copies go through sendfile/CopyFileExW which read ahead by themselves
+                prefetch_file(job.input_file_path)
+            job_queue.put(job)
+    except Exception as e: # Kept for copy_tree to raise, otherwise the thread would just print it and the run would
+        errors.append(e)   # look like it finished
+    finally:
+        job_queue.put(None) # Always tells the consumer the walk is over, even if it failed
+
+def run_jobs(job_list, jobs, convert_options, on_done=None): # Hands the WAVs to a pool of workers and the copies
+    pending = deque()                                          # to a pool of threads so they all run at once. At most 2
+    copying = deque()                                          # jobs per worker are queued up at once, so a huge tree
+    small_batch = []                                           # doesn't run ahead of the encoders. on_done gets each job
+    available_space = 0                                        # and whether it worked once it's finished, always on this
+    written_since_check = 0                                    # thread
+    sidecars = {}
+    convert_options = dict(convert_options)
+    aggregate_below = convert_options.pop('aggregate_below', 0) # Only used here, the rest goes to the conversions
+    # PyAV doesn't start a process per file and flake/flac only take one at a time, so only ffmpeg batches. It can only
+    # be piped one WAV though, so streaming turns it off too
+    batch_small = (av is None and convert_options.get('encoder', 'ffmpeg') == 'ffmpeg'
+                   and not convert_options.get('stream_input'))
+    # PyAV encodes inside the worker so it needs real processes, otherwise every worker just waits on an encoder process
+    # and a thread does that without starting a whole Python for it
+    in_process = av is not None and convert_options.get('encoder', 'ffmpeg') == 'ffmpeg'
+    pool = ProcessPoolExecutor if in_process else ThreadPoolExecutor
+    priority = convert_options.pop('priority', None)
+    pool_options = {}
+    # Workers get spawned instead of forked, the walker and csv threads are already running by now and a fork could copy
+    # a lock one of them is holding (like stdout's) into the worker, which would then hang on it forever
+    if in_process:
+        pool_options['mp_context'] = multiprocessing.get_context('spawn')
+    if in_process and priority: # Worker processes don't get a high priority passed on either, so they set their own
+        pool_options.update(initializer=set_priority, initargs=(priority,))
+
+    def submit(batch): # Sends a batch of WAVs off to the pool, waiting on the oldest one if too many are queued up
+        pending.append((batch, executor.submit(_convert_batch, batch, **convert_options)))
+        if len(pending) > 2 * jobs:
+            finish_oldest()
+
+    def finish_oldest(): # Waits on the oldest conversion and logs anything that failed
+        batch, future = pending.popleft()
+        for job, converted in zip(batch, future.result()):
+            if not converted:
+                log_file_failure(job.input_file_path)
+            if on_done:
+                on_done(job, converted)
+
+    def finish_oldest_copy(): # Waits on the oldest copy, copy_file already logs it if it failed
+        job, future = copying.popleft()
+        copied = future.result()
+        if on_done:
+            on_done(job, copied)
+
+    def finish_sidecars(): # Closes the open zip, the files in it are only done once it's been swapped in
+        for job in close_sidecars(sidecars):
+            if on_done:
+                on_done(job, True)
+
+    with pool(max_workers=jobs, **pool_options) as executor, ThreadPoolExecutor(max_workers=COPY_WORKERS) as copier:
+        try:
+            for job in job_list:
+                if job.kind == 'wav':
+                    if batch_small and job.file_size < SMALL_WAV_BYTES:
+                        small_batch.append(job)
+                        if len(small_batch) == SMALL_WAV_BATCH:
+                            submit(small_batch)
+                            small_batch = []
+                    else:
+                        submit([job])
+                    continue
+
+                # Free space only gets looked up again every so often
+                if job.file_size > available_space or written_since_check >= SPACE_RECHECK_BYTES:
+                    try:
+                        available_space = get_available_space(os.path.dirname(job.output_file_path))
+                    except OSError as e: # Its folder couldn't be made, so there's nowhere to copy it to
+                        print(f'Failed to copy {job.input_file_path} to {job.output_file_path}: {e}')
+                        log_file_failure(job.input_file_path)
+                        if on_done:
+                            on_done(job, False)
+                        continue
+                    for copy, future in copying:
+                        if not future.done(): # Still being written, so the drive isn't showing all of it yet
+                            available_space -= copy.file_size
+                    written_since_check = 0
+
+                if job.file_size > available_space:
+                    print(f'Insufficient space to copy {job.input_file_path}. '
+                          f'Required: {job.file_size}, Available: {available_space}')
+                    if on_done:
+                        on_done(job, False)
+                    continue
+
+                available_space -= job.file_size
+                written_since_check += job.file_size
+                if job.file_size < aggregate_below: # Small enough that opening a file for it costs more than writing it
+                    if sidecars.get('folder') != os.path.dirname(job.output_file_path):
+                        finish_sidecars()
+                    if not add_to_sidecars(job, sidecars) and on_done:
+                        on_done(job, False)
+                    continue
+
+                copying.append((job, copier.submit(copy_file, job.input_file_path, job.output_file_path)))
+                if len(copying) > 2 * COPY_WORKERS:
+                    finish_oldest_copy()
+
+            if small_batch:
+                submit(small_batch)
+            while pending:
+                finish_oldest()
+            while copying:
+                finish_oldest_copy()
+        finally: # Even if the run stops partway, so the files already stored in the open zip still count
+            finish_sidecars()
+
+def copy_tree(source, drive_folder, jobs, convert_options, manifest): # Walks the source on a producer thread feeding the
+    job_queue = queue.Queue(maxsize=2 * jobs)                            # jobs straight to run_jobs, and records everything
+    producer_errors = []                                                 # that finishes in the manifest
+    producer = threading.Thread(
+        target=produce_jobs,
+        args=(source, drive_folder, job_queue, manifest, producer_errors),
+        daemon=True
+    )
+    producer.start()
+
+    destination_root = with_sep(drive_folder) # Same prefix iter_jobs puts on every output path
+    finished_since_save = 0
+    def on_done(job, succeeded): # Failures stay out of the manifest so the next run tries them again
+        nonlocal finished_since_save
+        if not succeeded:
+            return
+        manifest[job.relative_path] = [job.mtime_ns, job.file_size, job.output_file_path[len(destination_root):]]
+        finished_since_save += 1
+        if finished_since_save >= MANIFEST_SAVE_INTERVAL:
+            save_manifest(source, drive_folder, manifest)
+            finished_since_save = 0
+
+    try:
+        run_jobs(iter(job_queue.get, None), jobs, convert_options, on_done)
+    finally:
+        save_manifest(source, drive_folder, manifest)
+    producer.join()
+    if producer_errors: # The walk died partway, so the run didn't really finish
+        raise producer_errors[0]
+
+def compare_and_copy(source, drive_folder, jobs, convert_options): # Skips what the manifest says is done and unchanged, then
+    manifest = load_manifest(source, drive_folder)                    # searches through copied files, so in the case your run
+    if manifest:                                                      # gets cancelled mid copy it begins the process where you
+        print(f'Loaded manifest with {len(manifest)} finished files.') # left off, and a fresh destination just copies it all
+    copy_tree(source, drive_folder, jobs, convert_options, manifest)
+
+def copy_directory(source, destination, jobs, convert_options): # Copies the source directory to the destination
+    try:
+        os.makedirs(destination, exist_ok=True)
+    except OSError as e:
+        print(f"Failed to create directory {destination}: {e}")
+        return
+
+    drive_name = get_drive_name(source)
+    drive_folder = os.path.join(destination, drive_name)
+    try:
+        os.makedirs(drive_folder, exist_ok=True)
+    except OSError as e:
+        print(f"Failed to create drive folder {drive_folder}: {e}")
+        return
+
+    compare_and_copy(source, drive_folder, jobs, convert_options)
+
+def main(): # Reads congig.json, gets the source, destination and csv, then copies
+    try:
+        config = load_config('config.json')
+        if not config:
+            print("Error: Configuration file 'config.json' not found.")
+            return
+
+        source_dir = config.get('source_dir', '')
+        destination_dir = config.get('destination_dir', '')
+        csv_file = config.get('csv_file_path', 'copy_failures.csv')
+        jobs = config.get('jobs', default_jobs())
+        convert_options = {
+            'threads': config.get('ffmpeg_threads', default_ffmpeg_threads(jobs)),
+            'channels': config.get('force_channels'),
+            'encoder': config.get('encoder', 'ffmpeg'),
+            'block_size': config.get('block_size', 4608),
+            'lpc_order': config.get('lpc_order'),
+            'stream_input': STREAM_INPUT_BUDGET_BYTES // jobs if config.get('stream_input') else 0,
+            # Off unless it's turned on, since the small files end up inside a zip instead of next to everything else
+            'aggregate_below': config.get('aggregate_threshold', AGGREGATE_THRESHOLD) if config.get('aggregate_small_files') else 0,
+            'priority': config.get('priority')
+        }
+        if convert_options['encoder'] not in ENCODERS:
+            raise ValueError(f"Unknown encoder '{convert_options['encoder']}', use one of {', '.join(ENCODERS)}")
+        priority = convert_options['priority']
+        if priority:
+            if priority not in PRIORITIES:
+                raise ValueError(f"Unknown priority '{priority}', use one of {', '.join(PRIORITIES)}")
+            set_priority(priority)
+
+        failure_log = start_failure_log(csv_file)
+        try:
+            copy_directory(source_dir, destination_dir, jobs, convert_options)
+        finally:
+            stop_failure_log(failure_log)
+        print(f'Successfully copied directory {source_dir} to {destination_dir}')
+
+    except FileNotFoundError:
+        print("Error: Configuration file 'config.json' not found.")
+    except PermissionError as e:
+        print(f"Permission error: {e}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+    main()